@@ -1,4 +1,8 @@
-import boto3, json, os, pip, shutil, time, uuid
+import boto3, hashlib, json, os, shutil, subprocess, sys, time, uuid, zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 
 ################################################################################
@@ -12,7 +16,25 @@ LAMBDA_ROLE_NAME = 'LambdaRoleTPAPIChallenge'
 LAMBDA_ROLE_DESCRIPTION = 'Role for TrustPilot API challenge lambda'
 LAMBDA_FUNCTION_NAME = 'TrustPilotAPIChallengeLambda'
 LAMBDA_FUNCTION_DESCRIPTION = "A lambda function for Trust Pilot's API challenge"
+LAMBDA_PYTHON_VERSION = '3.12'
+LAMBDA_PLATFORM = 'manylinux2014_x86_64'
+LAMBDA_ALIAS_NAME = 'live'
+# lambda allocates cpu in proportion to memory, so this also
+# sets how quickly reviews are scored
+LAMBDA_MEMORY_SIZE = 1024
+# SnapStart isn't available in every region, set to False where it isn't
+LAMBDA_SNAP_START = True
+# set above 0 to keep this many instances of the alias initialised.
+# lambda doesn't allow this together with SnapStart, so SnapStart
+# is skipped when this is set.
+LAMBDA_PROVISIONED_CONCURRENCY = 0
 TMP_DIRECTORY_ROOT = '/tmp/trustpilotapi'
+DEPENDENCY_CACHE_ROOT = os.path.expanduser('~/.cache/tpapi_deps')
+LAMBDA_ROLE_RETRY_DELAYS = (1, 2, 4, 8)
+
+# S3 SETTINGS
+# the account id and region are appended to keep the name unique
+S3_CODE_BUCKET_PREFIX = 'trustpilot-api-challenge'
 
 # API GATEWAY SETTINGS
 API_GATEWAY_REST_API_NAME = 'TrustPilotChallengeAPI'
@@ -23,18 +45,55 @@ API_GATEWAY_REQUEST_VALIDATOR_NAME = 'Trust Pilot API request validator'
 ################################################################################
 
 
+# one session shared by every client, so service models are only
+# loaded once and connections are reused between calls. Every
+# client has a large enough pool for the concurrent calls and
+# uploads, and backs off adaptively when throttled.
+SESSION = boto3.session.Session(region_name=AWS_REGION)
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={
+        'max_attempts': 10,
+        'mode': 'adaptive',
+    },
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+)
+IAM = SESSION.client('iam', config=CLIENT_CONFIG)
+LAMBDA = SESSION.client('lambda', config=CLIENT_CONFIG)
+APIGW = SESSION.client('apigateway', config=CLIENT_CONFIG)
+STS = SESSION.client('sts', config=CLIENT_CONFIG)
+S3 = SESSION.client('s3', config=CLIENT_CONFIG)
+
+# large packages are uploaded in parallel parts
+S3_UPLOAD_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+# POST rather than GET, see the note in create_api_gateway
+API_GATEWAY_HTTP_METHOD = 'POST'
+
+
 def main():
-    # create the role for lambda
-    lambda_role_arn = create_lambda_iam_role()
-    
-    # this is ugly but the next stage fails if I don't wait!
-    time.sleep(10)
+    account_id = STS.get_caller_identity()['Account']
+
+    # the role, the lambda package and the api gateway resource
+    # don't depend on each other, so these are built side by side
+    lambda_role_arn, lambda_code, (rest_api_id, resource_id) = run_concurrently(
+        (create_lambda_iam_role, {}),
+        (upload_lambda_package, {'account_id': account_id}),
+        (create_api_gateway_resource, {}),
+    )
 
     # build the lambda function
-    create_lambda_function(lambda_role_arn=lambda_role_arn)
+    create_lambda_function(lambda_role_arn=lambda_role_arn, lambda_code=lambda_code)
 
     # create the api gateway setup
-    api_url = create_api_gateway()
+    api_url = create_api_gateway(account_id=account_id, rest_api_id=rest_api_id,
+        resource_id=resource_id)
 
     # print out the url of the api
     print ('-------------------------------------------')
@@ -52,7 +111,7 @@ def create_lambda_iam_role():
     """
     print ('Creating IAM Role for lambda function')
 
-    client = boto3.client('iam')
+    client = IAM
 
     assume_role_policy = json.dumps({
         'Version': '2012-10-17',
@@ -85,76 +144,221 @@ def create_lambda_iam_role():
         PolicyArn=policy_arn
     )
 
+    # wait for the role to be visible before handing it to lambda
+    client.get_waiter('role_exists').wait(
+        RoleName=LAMBDA_ROLE_NAME,
+        WaiterConfig={
+            'Delay': 1,
+            'MaxAttempts': 15,
+        }
+    )
+
     print ('- Role created successfully.')
     return lambda_role_arn
 
 
-def create_lambda_function(lambda_role_arn):
+def package_lambda_function():
     """
-    Moves the lambda function directory to temp location,
-    installs the requirements into that temp location, zips
-    these files and uploads to AWS lambda to create a function.
+    Installs the requirements and zips them together with
+    the lambda function directory, returning the path to
+    the zip. Files are written straight into the zip from
+    where they are, rather than being copied to a temp
+    location first.
     """
-    print ('Creating lambda function')
-    # copy the lambda files to temp location
+    print ('Packaging lambda function')
     current_directory = os.getcwd()
     lambda_directory = os.path.join(current_directory, 'lambda')
-    tmp_directory_lambda = os.path.join(TMP_DIRECTORY_ROOT, 'lambda')
+    dependency_directory = install_lambda_requirements()
 
     shutil.rmtree(TMP_DIRECTORY_ROOT, ignore_errors=True)
-    shutil.copytree(lambda_directory, tmp_directory_lambda)
-
-    # install pip into temp directory
-    pip.main(['install', '-r', 'lambda/requirements.txt', '-t' ,tmp_directory_lambda])
+    os.makedirs(TMP_DIRECTORY_ROOT)
 
     # zip the contents to be sent to lambda
-    zip_dir = os.path.join(TMP_DIRECTORY_ROOT, 'lambda_zip')
-    zip_file = shutil.make_archive(zip_dir, 'zip', tmp_directory_lambda)
+    zip_file = os.path.join(TMP_DIRECTORY_ROOT, 'lambda_zip.zip')
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        zip_directory(zf, lambda_directory)
+        zip_directory(zf, dependency_directory)
 
-    # create lambada function
-    client = boto3.client('lambda', region_name=AWS_REGION)
-    response = client.create_function(
-        FunctionName=LAMBDA_FUNCTION_NAME,
-        Runtime='python3.6',
-        Role=lambda_role_arn,
-        Handler='lambda_function.lambda_handler',
-        Code={
-            'ZipFile': open(zip_file, 'rb').read()
-        },
-        Description=LAMBDA_FUNCTION_DESCRIPTION,
-        Timeout=30,
-        MemorySize=128,
-    )
+    print ('- Lambda function packaged successfully.')
+    return zip_file
 
-    print ('- Lambda funciton created successfully.')
 
+def upload_lambda_package(account_id):
+    """
+    Packages the lambda function and uploads the zip to
+    the code bucket in S3, creating the bucket if it doesn't
+    already exist. Returns the location of the code for
+    creating the lambda function.
+    """
+    zip_file = package_lambda_function()
+
+    print ('Uploading lambda package to S3')
 
-def create_api_gateway():
+    bucket = '%s-%s-%s' % (S3_CODE_BUCKET_PREFIX, account_id, AWS_REGION)
+    key = '%s.zip' % LAMBDA_FUNCTION_NAME
+
+    try:
+        S3.head_bucket(Bucket=bucket)
+    except ClientError as e:
+        if e.response['Error']['Code'] != '404':
+            raise
+
+        # us-east-1 is the default and can't be given as a constraint
+        kwargs = {}
+        if AWS_REGION != 'us-east-1':
+            kwargs['CreateBucketConfiguration'] = {
+                'LocationConstraint': AWS_REGION,
+            }
+        S3.create_bucket(Bucket=bucket, **kwargs)
+        S3.get_waiter('bucket_exists').wait(Bucket=bucket)
+
+    # the transfer manager streams the file from disk in parallel parts
+    S3.upload_file(zip_file, bucket, key, Config=S3_UPLOAD_CONFIG)
+
+    print ('- Lambda package uploaded successfully.')
+    return {
+        'S3Bucket': bucket,
+        'S3Key': key,
+    }
+
+
+def zip_directory(zf, directory):
+    """
+    Writes every file under the directory into the open zip
+    file, with paths relative to the directory. Python's
+    bytecode caches are skipped.
     """
-    Creates a REST API in API gateway, that has one method 
-    and one resource specified in the settings, which calls
-    the lambda function.
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        for name in files:
+            if name.endswith('.pyc'):
+                continue
+            path = os.path.join(root, name)
+            zf.write(path, os.path.relpath(path, directory))
 
-    The API has two query string parameters, domain and limit.
 
-    The API is then deployed to be publically accessible, and
-    end point is returned, with sample query string parameters.
+def install_lambda_requirements():
+    """
+    Installs the lambda function's requirements into a cache
+    directory and returns its path. The cache is keyed on the
+    requirements and target runtime, so the install is skipped
+    when nothing has changed since the last deploy.
+    """
+    requirements_file = os.path.join('lambda', 'requirements.txt')
+    with open(requirements_file, 'rb') as f:
+        requirements = f.read()
+
+    key = hashlib.sha256(requirements)
+    key.update(('%s:%s' % (LAMBDA_PYTHON_VERSION, LAMBDA_PLATFORM)).encode())
+    cache_directory = os.path.join(DEPENDENCY_CACHE_ROOT, key.hexdigest())
+
+    if os.path.isdir(cache_directory):
+        print ('- Using cached requirements.')
+        return cache_directory
+
+    # install binary wheels that match the lambda runtime, into a
+    # separate directory first so a failed install isn't cached.
+    install_directory = cache_directory + '.tmp'
+    shutil.rmtree(install_directory, ignore_errors=True)
+    subprocess.run([
+        sys.executable, '-m', 'pip', 'install',
+        '--prefer-binary',
+        '--only-binary=:all:',
+        '--platform', LAMBDA_PLATFORM,
+        '--python-version', LAMBDA_PYTHON_VERSION,
+        '-r', requirements_file,
+        '-t', install_directory,
+    ], check=True)
+    os.rename(install_directory, cache_directory)
+
+    return cache_directory
+
+
+def create_lambda_function(lambda_role_arn, lambda_code):
+    """
+    Creates the lambda function from the code uploaded to S3,
+    publishes a version and points the alias at it.
 
-    NOTE: There appears to be a problem creating GET requests
-    with lambda through the SDK where it throws a forbidden error.
-    This is discussed here:
+    With SnapStart, published versions are started from a
+    snapshot of the initialised function, so cold starts
+    skip importing the modules.
+    """
+    print ('Creating lambda function')
 
-    https://forums.aws.amazon.com/thread.jspa?messageID=745586&#745586
+    # create lambada function
+    client = LAMBDA
+
+    # a version can't use SnapStart and provisioned concurrency
+    snap_start = LAMBDA_SNAP_START and not LAMBDA_PROVISIONED_CONCURRENCY
+    if LAMBDA_SNAP_START and not snap_start:
+        print ('- Skipping SnapStart as provisioned concurrency is set.')
+
+    # the role can exist in IAM before lambda is able to assume
+    # it, so back off and retry until it has propagated.
+    for delay in LAMBDA_ROLE_RETRY_DELAYS + (None,):
+        try:
+            response = client.create_function(
+                FunctionName=LAMBDA_FUNCTION_NAME,
+                Runtime='python%s' % LAMBDA_PYTHON_VERSION,
+                Role=lambda_role_arn,
+                Handler='lambda_function.lambda_handler',
+                Code=lambda_code,
+                Description=LAMBDA_FUNCTION_DESCRIPTION,
+                Timeout=30,
+                MemorySize=LAMBDA_MEMORY_SIZE,
+                SnapStart={
+                    'ApplyOn': 'PublishedVersions' if snap_start else 'None',
+                },
+            )
+            break
+        except ClientError as e:
+            error = e.response['Error']
+            if (delay is None
+                    or error['Code'] != 'InvalidParameterValueException'
+                    or 'cannot be assumed' not in error['Message']):
+                raise
+            print ('- Role not yet assumable, retrying in %ss' % delay)
+            time.sleep(delay)
+
+    # a version can only be published once the function is active.
+    # with SnapStart, publishing the version takes the snapshot, and
+    # the version isn't active until the snapshot is ready.
+    client.get_waiter('function_active_v2').wait(FunctionName=LAMBDA_FUNCTION_NAME)
+    response = client.publish_version(FunctionName=LAMBDA_FUNCTION_NAME)
+    version = response['Version']
+    client.get_waiter('published_version_active').wait(
+        FunctionName=LAMBDA_FUNCTION_NAME,
+        Qualifier=version,
+    )
 
-    It's also discussed on Github.
+    client.create_alias(
+        FunctionName=LAMBDA_FUNCTION_NAME,
+        Name=LAMBDA_ALIAS_NAME,
+        FunctionVersion=version,
+    )
 
-    So for now the POST http method is used.
+    if LAMBDA_PROVISIONED_CONCURRENCY:
+        client.put_provisioned_concurrency_config(
+            FunctionName=LAMBDA_FUNCTION_NAME,
+            Qualifier=LAMBDA_ALIAS_NAME,
+            ProvisionedConcurrentExecutions=LAMBDA_PROVISIONED_CONCURRENCY,
+        )
+
+    print ('- Lambda funciton created successfully.')
+
+
+def create_api_gateway_resource():
     """
-    print ('Creating API Gateway')
+    Creates a REST API in API gateway with the resource and
+    method specified in the settings, returning the ids of
+    the rest api and the resource.
 
-    API_GATEWAY_HTTP_METHOD = 'POST'
+    None of this depends on the lambda function, so it can
+    be built while the function is being packaged.
+    """
+    print ('Creating API Gateway resource')
 
-    client = boto3.client('apigateway', region_name=AWS_REGION)
+    client = APIGW
 
     # first have to create the rest api
     response = client.create_rest_api(
@@ -187,74 +391,57 @@ def create_api_gateway():
         operationName='Get trust score',
     )
 
+    print ('- API Gateway resource created successfully.')
+    return rest_api_id, resource_id
+
+
+def create_api_gateway(account_id, rest_api_id, resource_id):
+    """
+    Integrates the method of the REST API's resource with
+    the lambda function's alias.
+
+    The API has two query string parameters, domain and limit.
+
+    The API is then deployed to be publically accessible, and
+    end point is returned, with sample query string parameters.
+
+    NOTE: There appears to be a problem creating GET requests
+    with lambda through the SDK where it throws a forbidden error.
+    This is discussed here:
+
+    https://forums.aws.amazon.com/thread.jspa?messageID=745586&#745586
+
+    It's also discussed on Github.
+
+    So for now the POST http method is used.
+    """
+    print ('Creating API Gateway')
+
+    client = APIGW
+
     # create integration
-    lambda_client = boto3.client('lambda', region_name=AWS_REGION)
-    lambda_version = lambda_client.meta.service_model.api_version
-    account_id = boto3.client('sts').get_caller_identity().get('Account')
+    lambda_version = LAMBDA.meta.service_model.api_version
 
     uri_data = {
         'aws-region': AWS_REGION,
         'api-version': lambda_version,
         'aws-acct-id': account_id,
         'lambda-function-name': LAMBDA_FUNCTION_NAME,
+        'lambda-alias-name': LAMBDA_ALIAS_NAME,
     }
 
     # todo: surely there's a better way to do this?!
-    uri = 'arn:aws:apigateway:{aws-region}:lambda:path/{api-version}/functions/arn:aws:lambda:{aws-region}:{aws-acct-id}:function:{lambda-function-name}/invocations'.format(**uri_data)
-
-    client.put_integration(
-        restApiId=rest_api_id,
-        resourceId=resource_id,
-        httpMethod=API_GATEWAY_HTTP_METHOD,
-        type='AWS',
-        integrationHttpMethod=API_GATEWAY_HTTP_METHOD,
+    uri = 'arn:aws:apigateway:{aws-region}:lambda:path/{api-version}/functions/arn:aws:lambda:{aws-region}:{aws-acct-id}:function:{lambda-function-name}:{lambda-alias-name}/invocations'.format(**uri_data)
+
+    # api gateway rejects concurrent changes to the same rest api,
+    # so these calls are made in order
+    integrate_api_gateway_method(
+        client=client,
+        rest_api_id=rest_api_id,
+        resource_id=resource_id,
         uri=uri,
     )
 
-    client.put_integration_response(
-        restApiId=rest_api_id,
-        resourceId=resource_id,
-        httpMethod=API_GATEWAY_HTTP_METHOD,
-        statusCode='200',
-        selectionPattern='-'
-    )
-
-    client.put_method_response(
-        restApiId=rest_api_id,
-        resourceId=resource_id,
-        httpMethod=API_GATEWAY_HTTP_METHOD,
-        statusCode='200',
-    )
-
-
-    # make updates to the various parts of the method
-    body_mapping_template = """
-        #set($limit = $input.params('limit'))
-        {
-            #if($limit && $limit.length() != 0)
-                "limit": $input.params('limit'),
-            #end
-            "domain": "$input.params('domain')"
-        }
-    """
-    client.update_integration(
-        restApiId=rest_api_id,
-        resourceId=resource_id,
-        httpMethod=API_GATEWAY_HTTP_METHOD,
-        patchOperations=[
-            {
-                'op': 'add',
-                'path': '/requestTemplates/application~1json',
-                'value': body_mapping_template,
-            },
-            {
-                'op': 'replace',
-                'path': '/passthroughBehavior',
-                'value': 'WHEN_NO_TEMPLATES',
-            }
-        ]
-    )
-
     # create request validator
     response = client.create_request_validator(
         restApiId=rest_api_id,
@@ -296,8 +483,9 @@ def create_api_gateway():
     uri_data['http-method'] = API_GATEWAY_HTTP_METHOD
     source_arn = 'arn:aws:execute-api:{aws-region}:{aws-acct-id}:{aws-api-id}/*/{http-method}/{resource-path}'.format(**uri_data)
 
-    lambda_client.add_permission(
+    LAMBDA.add_permission(
         FunctionName=LAMBDA_FUNCTION_NAME,
+        Qualifier=LAMBDA_ALIAS_NAME,
         StatementId=uuid.uuid4().hex,
         Action='lambda:InvokeFunction',
         Principal='apigateway.amazonaws.com',
@@ -322,5 +510,90 @@ def create_api_gateway():
     return 'https://{aws-api-id}.execute-api.{aws-region}.amazonaws.com/{stage-name}/{resource-path}?domain=google.co.uk&limit=10'.format(**api_data)
 
 
+def integrate_api_gateway_method(client, rest_api_id, resource_id, uri):
+    """
+    Integrates the resource's method with the uri, and sets
+    up the method's responses and body mapping template.
+    """
+    client.put_integration(
+        restApiId=rest_api_id,
+        resourceId=resource_id,
+        httpMethod=API_GATEWAY_HTTP_METHOD,
+        type='AWS',
+        integrationHttpMethod=API_GATEWAY_HTTP_METHOD,
+        uri=uri,
+    )
+
+    client.put_integration_response(
+        restApiId=rest_api_id,
+        resourceId=resource_id,
+        httpMethod=API_GATEWAY_HTTP_METHOD,
+        statusCode='200',
+        selectionPattern='-'
+    )
+
+    client.put_method_response(
+        restApiId=rest_api_id,
+        resourceId=resource_id,
+        httpMethod=API_GATEWAY_HTTP_METHOD,
+        statusCode='200',
+    )
+
+    # make updates to the various parts of the method
+    body_mapping_template = """
+        #set($limit = $input.params('limit'))
+        {
+            #if($limit && $limit.length() != 0)
+                "limit": $input.params('limit'),
+            #end
+            "domain": "$input.params('domain')"
+        }
+    """
+    client.update_integration(
+        restApiId=rest_api_id,
+        resourceId=resource_id,
+        httpMethod=API_GATEWAY_HTTP_METHOD,
+        patchOperations=[
+            {
+                'op': 'add',
+                'path': '/requestTemplates/application~1json',
+                'value': body_mapping_template,
+            },
+            {
+                'op': 'replace',
+                'path': '/passthroughBehavior',
+                'value': 'WHEN_NO_TEMPLATES',
+            }
+        ]
+    )
+
+
+def run_concurrently(*calls):
+    """
+    Runs each call on its own thread and waits for them all
+    to finish. Each call is a (function, kwargs) tuple and
+    the results are returned in the same order as the calls.
+
+    If a call fails, the calls that haven't started are
+    cancelled and the failure is raised straight away,
+    without waiting for the calls still running.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(calls))
+    futures = [executor.submit(function, **kwargs) for function, kwargs in calls]
+
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except Exception:
+        # cancel by hand, as shutdown's cancel_futures needs python 3.9
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+
+    executor.shutdown()
+    return [future.result() for future in futures]
+
+
 if __name__ == '__main__':
     main()
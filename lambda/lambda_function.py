@@ -1,13 +1,26 @@
+import math
+
 from trustpilot.classes import TrustPilot
 
 
 def lambda_handler(event, context):
     domain = event['domain']
     limit = event.get('limit', 300)
+
+    # api gateway passes the limit through as raw json, so it can
+    # be a float. Reviews are counted until the limit is reached,
+    # so round up to the whole number of reviews that reaches it.
+    review_limit = math.ceil(limit)
+
+    # api gateway doesn't validate the limit, so reject it here
+    # before looking up the business unit
+    if review_limit < 1:
+        raise ValueError('limit must be at least 1, got %r' % limit)
+
     tp = TrustPilot(domain=domain)
     
     return {
         'domain': domain,
         'limit': limit,
-        'trust_score': tp.get_trustscore(limit=limit),
+        'trust_score': tp.get_trustscore(limit=review_limit),
     }
@@ -1,14 +1,81 @@
-import decimal, json, math, requests
+import functools, math, orjson, requests
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib3.util.retry import Retry
 
 from .settings import API_KEY, BUSINESS_UNIT_REVIEWS_API_URL, FIND_BUSINESS_UNIT_API_URL
 
 
+# the most reviews the api will return in one page
+_MAX_PER_PAGE = 100
+
+# some reviews don't count towards the score, so pages ask for
+# more than are needed, as another round trip to the api costs
+# far more than a few extra reviews
+_PAGE_SIZE_MULTIPLIER = 2
+_PAGE_SIZE_PADDING = 20
+
+# the score thresholds are translated log functions of the number
+# of reviews that both start at 6. Their inputs never change, so
+# the y translations are calculated once here.
+_THRESHOLD_STARTING_SCORE = 6
+_MAX_THRESHOLD_X_TRANSLATION = 0
+_MAX_THRESHOLD_Y_TRANSLATION = _THRESHOLD_STARTING_SCORE - math.log(_MAX_THRESHOLD_X_TRANSLATION + 1)
+_MIN_THRESHOLD_X_TRANSLATION = 5
+_MIN_THRESHOLD_BASE = 1.5
+_MIN_THRESHOLD_Y_TRANSLATION = _THRESHOLD_STARTING_SCORE + math.log(_MIN_THRESHOLD_X_TRANSLATION + 1, _MIN_THRESHOLD_BASE)
+
+# multiplying a natural log by this changes it to the min threshold's base
+_INV_LOG_MIN_THRESHOLD_BASE = 1 / math.log(_MIN_THRESHOLD_BASE)
+
+
+# one session for all requests to the api, kept at module level
+# so warm lambdas reuse open connections rather than reconnecting
+_SESSION = requests.Session()
+_SESSION.headers.update({'apikey': API_KEY})
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.2),
+))
+
+# fetches the next page of reviews while the current one is
+# processed, kept at module level so warm lambdas reuse it.
+_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+def _get_json(url):
+    """
+    Makes a GET request to the url parameter,
+    using the shared session that adds the API
+    key as a header, and returns the JSON.
+
+    The raw body is parsed with orjson, which is
+    much quicker than the json module requests uses.
+    """
+    response = _SESSION.get(url, timeout=5)
+    return orjson.loads(response.content)
+
+
+@functools.lru_cache(maxsize=1024)
+def _resolve_business_unit(domain):
+    """
+    Returns the business unit for the domain. This is
+    cached, so warm lambdas don't look up the same
+    domain again.
+    """
+    url = FIND_BUSINESS_UNIT_API_URL % { 'domain' : domain }
+    data = _get_json(url)
+    return data['id']
+
+
 class TrustPilot:
     def __init__(self, domain):
         self.domain = domain
-        self.business_unit = self._get_business_unit()
+        self.business_unit = _resolve_business_unit(domain)
 
     def get_trustscore(self, limit=300):
         """
@@ -17,9 +84,10 @@ class TrustPilot:
         where x is determined by the limit parameter.
         """
         # define the starting url and query string
-        # for retrieving reviews.
+        # for retrieving reviews, not asking for many
+        # more than are needed.
         query_string = urlencode({
-            'perPage': 100,
+            'perPage': self._page_size(remaining=limit),
         })
 
         url = BUSINESS_UNIT_REVIEWS_API_URL % { 
@@ -29,93 +97,114 @@ class TrustPilot:
 
         # get the datetime now as a benchmark for evaluating
         # age of reviews
-        now = datetime.now()
+        now = np.datetime64(datetime.now())
 
         # initialise starting variables
-        scores_list = []
-        max_scores_list = []
+        total_score = 0.0
+        total_max_score = 0.0
         review_count = 0
+        fetched_count = 0
 
-        review_count_reached = False
-        has_next = True
+        # get the first page of data from the api
+        data = _get_json(url)
         
         # loop until the end of the reviews or until the
         # limit has been reached.
-        while (not review_count_reached) and has_next:
-            # get the data from the api
-            data = self._get_json(url)
-
-            # loop through each review in the results
-            for review in data['reviews']:
-                # only process reviews that count towards score
-                if review['countsTowardsTrustScore']:
-                    # calculate score for review
-                    score, max_score = self._score_review(
-                        stars = review['stars'], 
-                        created_at = review['createdAt'],
-                        now = now,
-                    )
-
-                    # append to relevant lists
-                    scores_list.append(score)
-                    max_scores_list.append(max_score)
-
-                    # increment review counter
-                    review_count += 1
-
-                    # have we hit the review limit?
-                    if review_count >= limit:
-                        # don't process any more reviews
-                        review_count_reached = True
-                        break
-
-            # check to make sure there is another page
-            has_next = False
-            for link in data['links']:
-                if link['rel'] == 'next-page':
-                    has_next = True
-                    url = link['href']
-
+        while data is not None:
+            # if this page can't reach the limit, start getting
+            # the next page before processing this one
+            next_page = None
+            fetched_count += len(data['reviews'])
+
+            # only process reviews that count towards score,
+            # and no more than are needed to hit the limit
+            reviews = [review for review in data['reviews'] if review['countsTowardsTrustScore']]
+            reviews = reviews[:max(0, limit - review_count)]
+
+            remaining = limit - review_count - len(reviews)
+            if remaining > 0:
+                for link in data['links']:
+                    if link['rel'] == 'next-page':
+                        url = self._next_page_url(link['href'], fetched_count, remaining)
+                        next_page = _PREFETCH_EXECUTOR.submit(_get_json, url)
+
+            # score the page's reviews in one go, while the next
+            # page is downloading, and add them to the totals
+            scores, max_scores = self._score_reviews(
+                stars = np.array([review['stars'] for review in reviews], dtype=np.float64),
+                created_at = self._parse_dates([review['createdAt'] for review in reviews]),
+                now = now,
+            )
+            total_score += float(scores.sum())
+            total_max_score += float(max_scores.sum())
+            review_count += len(reviews)
+
+            # wait for the next page, if there is one
+            data = next_page.result() if next_page is not None else None
 
         # calculate the trustscore
-        trustscore = self._calculate_trustscore(scores_list=scores_list, 
-            max_scores_list=max_scores_list)
+        trustscore = self._calculate_trustscore(total_score=total_score, 
+            total_max_score=total_max_score, number_of_reviews=review_count)
 
-        # round the score and ensure python rounds up .5
-        context = decimal.getcontext()
-        context.rounding = decimal.ROUND_HALF_UP
-        return round(trustscore, 1) 
+        # round the score to 1dp, rounding .5 up. round() can't
+        # be used as it rounds halves to even and ignores decimal.
+        return math.floor(trustscore * 10 + 0.5) / 10
 
-    def _get_json(self, url):
+    def _page_size(self, remaining):
         """
-        Adds the API key as a header makes a
-        GET request to the url parameter and 
-        returns the JSON.
+        Returns how many reviews to ask for when there
+        are still the remaining number of reviews to be
+        scored, padded for reviews that don't count.
         """
-        headers = {'apikey': API_KEY }
-        response = requests.get(url, headers=headers)
-        return response.json()
+        page_size = remaining * _PAGE_SIZE_MULTIPLIER + _PAGE_SIZE_PADDING
+        return max(1, min(page_size, _MAX_PER_PAGE))
 
-    def _get_business_unit(self):
+    def _next_page_url(self, href, offset, remaining):
         """
-        Returns the business unit for this
-        instance's domain.
+        Returns the next page's url, resized so that it
+        doesn't ask for many more reviews than remain.
+
+        Pages are numbered by their size, so the size has
+        to divide the offset (the number of reviews already
+        retrieved) for the page to start at the next review.
+        This picks the smallest such size that covers the
+        padded page size, or failing that the largest size
+        allowed, and sets the page number to match.
         """
-        url = FIND_BUSINESS_UNIT_API_URL % { 'domain' : self.domain }
-        data = self._get_json(url)
-        return data['id']
+        page_size = self._page_size(remaining=remaining)
+        sizes = [size for size in range(1, _MAX_PER_PAGE + 1) if offset % size == 0]
+        per_page = next((size for size in sizes if size >= page_size), sizes[-1])
 
-    def _score_review(self, stars, created_at, now):
+        parsed = urlparse(href)
+        query = parse_qs(parsed.query)
+        query['perPage'] = [per_page]
+        query['page'] = [offset // per_page + 1]
+        return parsed._replace(query=urlencode(query, doseq=True)).geturl()
+
+    def _parse_dates(self, datetime_strs):
         """
-        Returns a score between 1 and 0 for the review
-        and the max score possible based on the date of
-        the review, as the weighting decreases over time.
+        Converts a list of API date strings, such as 
+        2017-11-05T14:02:11Z, to an array of datetime64.
+
+        Numpy parses the dates in C, but warns on the
+        trailing Z as it doesn't represent timezones,
+        so the strings are cut to 19 characters as they
+        are copied into a fixed width array.
+        """
+        return np.array(datetime_strs, dtype='U19').astype('datetime64[s]')
+
+    def _score_reviews(self, stars, created_at, now):
+        """
+        Returns arrays of scores between 1 and 0 for the
+        reviews and the max score possible based on the 
+        date of each review, as the weighting decreases 
+        over time.
         """
         total_score = self._score_stars(stars=stars)
 
         # get the date score so that aging can be applied
         # this is also the maximum possible score
-        date_score = max_score = self._score_date(datetime_str=created_at, now=now)
+        date_score = max_score = self._score_date(created_at=created_at, now=now)
 
         # apply aging and return
         aged_score = total_score * date_score
@@ -127,15 +216,17 @@ class TrustPilot:
         spaced out. 1 star will return a score of 0 and each 
         extra star will increase by 0.25, so that 5 returns 
         a score of 1.
+
+        Works on a single value or an array of stars.
         """
         stars_score = (stars - 1) * 0.25
         return stars_score
 
-    def _score_date(self, datetime_str, now):
+    def _score_date(self, created_at, now):
         """
         Using a logistic function sigmoid curve, returns
-        a value between 0 and 1 for the date parameter
-        relative to the now parameter. 
+        an array of values between 0 and 1 for the array
+        of datetime64 dates relative to the now parameter. 
 
         Dates closer to now will have a value closer to
         1. Dates further in the past will have a value
@@ -152,18 +243,17 @@ class TrustPilot:
         k = 0.004
         x0 = 365 * 0.5
 
-        # convert string date to datetime object and calc age in days
-        datetime_obj = datetime.strptime(datetime_str, '%Y-%m-%dT%H:%M:%SZ')
-        age_days = (now - datetime_obj).days
+        # calc age in whole days
+        age_days = (now - created_at).astype('timedelta64[D]').astype(np.float64)
             
         # calculate the logistic funciton value
-        logistic_value = L / (1 + math.exp(-k * (age_days - x0)))
+        logistic_value = L / (1 + np.exp(-k * (age_days - x0)))
 
         # transform so that new dates are closer to 1 and return
         logistic_value = -logistic_value + 1    
         return logistic_value
 
-    def _calculate_trustscore(self, scores_list, max_scores_list):
+    def _calculate_trustscore(self, total_score, total_max_score, number_of_reviews):
         """
         Calculate the trustscore.
         
@@ -175,8 +265,8 @@ class TrustPilot:
         of reviews having a really high or low score.
         """
         # calculate the trustscore and scale to Trust Pilot's scale
-        trustscore = sum(scores_list) / sum(max_scores_list) * 10
-        trustscore = self._check_score_threshold(trustscore, len(scores_list))
+        trustscore = total_score / total_max_score * 10
+        trustscore = self._check_score_threshold(trustscore, number_of_reviews)
         return trustscore
 
     def _check_score_threshold(self, score, number_of_reviews):
@@ -198,12 +288,7 @@ class TrustPilot:
         Calculate the maximum score possible based on the number
         of reviews. The threshold is determined by a log function.
         """
-        # should start at 6, so need to calculate the y translation
-        starting_score = 6
-        x_translation = 0
-        y_translation = starting_score - math.log(x_translation + 1)
-
-        max_score = math.log(number_of_reviews + x_translation) + y_translation
+        max_score = math.log(number_of_reviews + _MAX_THRESHOLD_X_TRANSLATION) + _MAX_THRESHOLD_Y_TRANSLATION
         return max_score
 
     def _min_score_threshold(self, number_of_reviews):
@@ -211,11 +296,6 @@ class TrustPilot:
         Calculate the minimum score possible based on the number
         of reviews. The threshold is determined by a log function.
         """
-        # should start at 6, so need to calculate the y translation
-        starting_score = 6
-        x_translation = 5
-        base = 1.5
-        y_translation = starting_score - (math.log(x_translation + 1, base) * -1)
-
-        min_score = math.log(number_of_reviews + x_translation, base) * -1 + y_translation
+        min_score = (-math.log(number_of_reviews + _MIN_THRESHOLD_X_TRANSLATION) * _INV_LOG_MIN_THRESHOLD_BASE
+            + _MIN_THRESHOLD_Y_TRANSLATION)
         return min_score